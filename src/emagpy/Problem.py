@@ -12,26 +12,41 @@ import pandas as pd
 import warnings
 import time
 import tempfile
+from functools import partial
 import matplotlib.pyplot as plt
 from matplotlib.collections import PolyCollection
 from matplotlib.colors import ListedColormap
 import matplotlib.tri as mtri
 # import matplotlib.patches as mpatches
 import matplotlib.path as mpath
-from scipy.optimize import minimize
+from scipy.optimize import minimize, least_squares
 from scipy.stats import linregress, gaussian_kde
 from scipy import interpolate
 
 # for parallel computing
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, effective_n_jobs
 from tqdm import tqdm
 
 # emagpy custom import
-from emagpy.invertHelper import (fCS, fMaxwellECa, fMaxwellQ, buildSecondDiff,
-                                 buildJacobian, getQs, eca2Q)
+from emagpy.invertHelper import (fCS, fCSbatch, fMaxwellECa, fMaxwellQ,
+                                 fMaxwellECabatch, fMaxwellQbatch,
+                                 buildSecondDiff, buildJacobian, factorize, getQs, eca2Q,
+                                 GOT_NUMBA, dicoCpos)
+if GOT_NUMBA:
+    from emagpy.invertHelper import objfuncCSnumba, objfuncGradCSnumba
 from emagpy.Survey import Survey, idw, clipConvexHull, griddata, tricontourf_clipped, clipConcaveHull
 
 
+def percentile(x, q):
+    """Percentile(s) `q` of all values of `x`. The slower NaN-aware
+    computation is only used if `x` contains NaN.
+    """
+    flat = np.ravel(x) # no copy if contiguous
+    if np.isnan(flat).any():
+        return np.nanpercentile(flat, q)
+    return np.percentile(flat, q)
+
+
 class HiddenPrints:
     # https://stackoverflow.com/questions/8391411/suppress-calls-to-print-python
     def __enter__(self):
@@ -46,8 +61,17 @@ class HiddenPrints:
 class Problem(object):
     """Class defining an inversion problem.
     
+    Parameters
+    ----------
+    dtype : numpy.dtype, optional
+        Floating point type of the apparent conductivities, inverted models,
+        depths and misfits stored and of the batched forward responses.
+        Default is `np.float64`. `np.float32` halves the memory used for
+        large surveys. The optimizers always work in float64.
     """
-    def __init__(self):
+    def __init__(self, dtype=np.float64):
+        self.dtype = dtype
+        
         # data attributes
         self.surveys = []
         self.freqs = []
@@ -82,6 +106,8 @@ class Problem(object):
         
         # others
         self.annReplaced = 0 # number of measurement outliers by ANN
+        self._kernelCache = {} # CS kernel matrices (see _buildKernelCS())
+        self._LCache = {} # roughness matrices (see _getL())
         
         
     def createSurvey(self, fname, freq=None, hx=None, targetProjection=None, unit='ppt'):
@@ -377,7 +403,7 @@ class Problem(object):
     def invert(self, forwardModel='CS', method='L-BFGS-B', regularization='l2',
                alpha=0.07, beta=0.0, gamma=0.0, dump=None, bnds=None,
                options={}, Lscaling=False, rep=100, noise=0.05, nsample=100, 
-               annplot=False, threed=False, njobs=1):
+               annplot=False, threed=False, njobs=1, vectorized=False):
         """Invert the apparent conductivity measurements.
         
         Parameters
@@ -395,6 +421,10 @@ class Problem(object):
             an artificial neural network on synthetic data and use it for inversion.
             Note that smoothing (alpha, beta, gamma) and regularization are not
             supported by ANN, MCMC, DREAM and SCUEA (but well by ROPE).
+            With l2 regularization and the CS, FSlin or FSeq forward models, the
+            gradient of the objective function is passed to L-BFGS-B, TNC and CG.
+            'lsq' uses `scipy.optimize.least_squares()` (trust region reflective)
+            on the vector of residuals with its Jacobian (l2 regularization only).
             Another option is the use of the Gauss-Newton (GN) algorithm which can be 
             faster in some situation. Maximum number of GN iteration can be specified as
             options={maxiter:3}. Default is 1.
@@ -418,7 +448,9 @@ class Problem(object):
             [(depth1_min, depth1_max),(depth2_min, depth2_max),
             (layer1_ec_min, layer1_ec_max),	(layer2_ec_min, layer2_ec_max),	(layer3_ec_min, layer3_ec_max)].
         options : dict, optional
-            Additional dictionary arguments will be passed to `scipy.optimize.minimize()`.
+            Additional dictionary arguments will be passed to `scipy.optimize.minimize()`
+            (or as keyword arguments to `scipy.optimize.least_squares()` for 'lsq',
+            with 'maxiter' used as 'max_nfev' and 'disp' as 'verbose').
         Lscaling : bool, optional
             **Experimental feature** If True the regularization matrix will be weighted based on 
             centroids of layers differences.
@@ -438,9 +470,22 @@ class Problem(object):
             If -1 all CPUs are used. If 1 is given, no parallel computing code
             is used at all, which is useful for debugging. For n_jobs below -1,
             (n_cpus + 1 + n_jobs) are used. Thus for n_jobs = -2, all CPUs
-            but one are used.
+            but one are used. With lateral smoothing (beta > 0), the survey
+            is split in contiguous chunks of profiles (one per job). Each chunk
+            is inverted sequentially and the first profile of each chunk is
+            inverted without lateral constrain.
+        vectorized : bool, optional
+            If `True`, the profiles of a survey are inverted together (by batch
+            of 100) in a single call to `scipy.optimize.minimize()` using a
+            batched forward model. This removes most of the Python overhead
+            of the row by row inversion. Only available for L-BFGS-B, TNC and
+            CG, with the CS forward model and without lateral smoothing
+            (beta = 0). Profiles with missing ECa are left at the initial model.
+            Best suited for fixed depths as, for non-linear problems, the shared
+            line search can converge to a different local minimum than the row
+            by row inversion.
         """
-        mMinimize = ['L-BFGS-B','TNC','CG','Nelder-Mead']
+        mMinimize = ['L-BFGS-B','TNC','CG','Nelder-Mead','lsq']
         mMCMC = ['ROPE','SCEUA','DREAM', 'MCMC']
         mOther = ['ANN','Gauss-Newton','GPS']
         if (method not in mMinimize) and (method not in mMCMC) and (method not in mOther):
@@ -457,6 +502,10 @@ class Problem(object):
             self.forwardModel = 'CS'
             return
         
+        if method == 'lsq' and regularization == 'l1':
+            print('Regularization automatically set to L2 for lsq')
+            regularization = 'l2'
+        
         if method == 'Gauss-Newton':
             if forwardModel == 'Q':
                 raise ValueError('Forward model Q can not be used with Gauss-Newton at the moment.'
@@ -494,6 +543,8 @@ class Problem(object):
         nd = self.depths0[0].shape[1] # number of depths
         vd = ~self.fixedDepths # variable depths
         vc = ~self.fixedConds # variable conductivity
+        nvd = np.sum(vd) # number of variable depths
+        nvc = np.sum(vc) # number of variable conductivities
         depths0 = self.depths0[0][0,:] # approximation
             
         # check time-lapse constrain
@@ -505,28 +556,71 @@ class Problem(object):
                     gamma = 0
         
         # check parallel
-        if njobs != 1 and beta != 0:
-            dump('WARNING: No parallel is possible with lateral smoothing (beta > 0).\n')
+        if njobs != 1 and beta != 0 and threed:
+            dump('WARNING: No parallel is possible with quasi-3D lateral smoothing.\n')
             njobs = 1
-            
-        # define the forward model
+
+        # check vectorized
+        if vectorized and (method not in ['L-BFGS-B', 'TNC', 'CG']):
+            dump('WARNING: Vectorized inversion is only possible with L-BFGS-B, TNC or CG.\n')
+            vectorized = False
+        if vectorized and beta != 0:
+            dump('WARNING: No vectorized inversion is possible with lateral smoothing (beta > 0).\n')
+            vectorized = False
+        if vectorized and forwardModel != 'CS':
+            # the shared problem needs several times more forward evaluations
+            # per profile, this only pays off when the forward model is cheap
+            dump('WARNING: Vectorized inversion is only faster with the CS forward model,'
+                 ' profiles are inverted one by one.\n')
+            vectorized = False
+        if vectorized:
+            njobs = 1 # all profiles of a batch are solved together
+
+        # define the forward model, the arguments that do not change between
+        # calls are bound once
+        if forwardModel == 'CS':
+            fwd = partial(fCS, s=self.cspacing, cpos=self.cpos, hx=self.hx)
+            fwdBatch = partial(fCSbatch, s=self.cspacing, cpos=self.cpos, hx=self.hx)
+        elif forwardModel == 'FSlin':
+            fwd = partial(fMaxwellECa, s=self.cspacing, cpos=self.cpos, f=self.freqs, hx=self.hx)
+            fwdBatch = partial(fMaxwellECabatch, s=self.cspacing, cpos=self.cpos, f=self.freqs, hx=self.hx)
+        elif forwardModel == 'FSeq':
+            fwd = partial(fMaxwellQ, s=self.cspacing, cpos=self.cpos, f=self.freqs, hx=self.hx)
+            fwdBatch = partial(fMaxwellQbatch, s=self.cspacing, cpos=self.cpos, f=self.freqs, hx=self.hx)
+        elif forwardModel in ['Q', 'QP']:
+            getQsp = partial(getQs, s=self.cspacing, cpos=self.cpos, f=self.freqs, hx=self.hx)
+            if forwardModel == 'Q':
+                def fwd(cond, depth):
+                    return np.imag(getQsp(cond, depth))
+            else:
+                fwd = getQsp
+            fwdBatch = None
+        else:
+            raise ValueError('Forward model {:s} is not available.'
+                             'Choose between CS, FSlin, FSeq, Q or QP'.format(forwardModel))
+        buildKernelCS = self._buildKernelCS
+
         def fmodel(p, ini0): # p contains first the depths then the conductivities
             depth = ini0[0].copy()
             cond = ini0[1].copy()
-            if np.sum(vd) > 0:
-                depth[vd] = p[:np.sum(vd)]
-            if np.sum(vc) > 0:
-                cond[vc] = p[np.sum(vd):]
-            if forwardModel == 'CS':
-                return fCS(cond, depth, self.cspacing, self.cpos, hx=self.hx)
-            elif forwardModel == 'FSlin':
-                return fMaxwellECa(cond, depth, self.cspacing, self.cpos, f=self.freqs, hx=self.hx)
-            elif forwardModel == 'FSeq':
-                return fMaxwellQ(cond, depth, self.cspacing, self.cpos, f=self.freqs, hx=self.hx)
-            elif forwardModel == 'Q':
-                return np.imag(getQs(cond, depth, self.cspacing, self.cpos, f=self.freqs, hx=self.hx))
-            elif forwardModel == 'QP':
-                return getQs(cond, depth, self.cspacing, self.cpos, f=self.freqs, hx=self.hx)
+            if nvd > 0:
+                depth[vd] = p[:nvd]
+            if nvc > 0:
+                cond[vc] = p[nvd:]
+            if forwardModel == 'CS' and nvd == 0: # fixed depths, CS is linear
+                return np.dot(buildKernelCS(depth), cond)
+            return fwd(cond, depth)
+
+        # batched forward model, P is Nprofile x Nparam and ini0s = (depths, conds),
+        # only used for the forward models with a batched version (CS, FSlin, FSeq)
+        def fmodelBatch(P, ini0s):
+            depth = ini0s[0].copy()
+            cond = ini0s[1].copy()
+            if nvd > 0:
+                depth[:,vd] = P[:,:nvd]
+            if nvc > 0:
+                cond[:,vc] = P[:,nvd:]
+            return fwdBatch(cond, depth)
 
         # define bounds
         if bnds is not None:
@@ -538,7 +632,7 @@ class Problem(object):
             else:
                 bounds = bnds
             # check len(bounds) match len(param)
-            nparam = np.sum(vd) + np.sum(vc)
+            nparam = nvd + nvc
             if len(bnds) != nparam:
                 raise ValueError('len(bounds) ({:d}) should be the same as '
                                  'the number of parameters ({:d})'.format(len(bounds), nparam))
@@ -554,7 +648,7 @@ class Problem(object):
                     # return
         else:
             bounds = None
-        if ((np.sum(vd) > 0) or (method in mMCMC)) and (bounds is None):
+        if ((nvd > 0) or (method in mMCMC)) and (bounds is None):
             # for MCMC method or fixed depths, we need bounds
             mdepths = depths0[:-1] + np.diff(depths0)/2
             bot = np.r_[np.r_[0.2, mdepths], np.ones(nc)*2]
@@ -591,10 +685,10 @@ class Problem(object):
                 fixedParams = None
                 nlayers = 2
             bestConds, bestDepths, bestMisfits, paramSd, paramMin, paramMax = self.gridParamSearch(forwardModel=fmodel, bnds=bnds, regularization=regularization, fixedParams=fixedParams)
-            self.models.append(bestConds)
-            self.depths.append(bestDepths)
-            self.misfits.append(bestMisfits)
-            self.pstds.append(paramSd)
+            self.models.append(np.asarray(bestConds, dtype=self.dtype))
+            self.depths.append(np.asarray(bestDepths, dtype=self.dtype))
+            self.misfits.append(np.asarray(bestMisfits, dtype=self.dtype))
+            self.pstds.append(np.asarray(paramSd, dtype=self.dtype))
 
         # build ANN network
         if method == 'ANN': # pragma: no cover
@@ -603,15 +697,14 @@ class Problem(object):
             dump('Building and training ANN network\n')
             t0 = time.time()
             if bounds is None: # happen where all depths are fixed
-                vmin = np.nanpercentile(self.surveys[0].df[self.coils].values, 2)
-                vmax = np.nanpercentile(self.surveys[0].df[self.coils].values, 98)
+                vmin, vmax = percentile(self.surveys[0].getApps(self.coils), [2, 98])
                 bounds = list(tuple(zip(np.ones(nc)*vmin, np.ones(nc)*vmax)))
                 dump('bounds = ' + str(bounds) + '\n')
             self.buildANN(fmodel, bounds, noise=noise, nsample=nsample, dump=dump, iplot=annplot)
             dump('Finish training the network ({:.2f}s)\n'.format(time.time() - t0))
             
         # build roughness matrix
-        L = buildSecondDiff(nc) # L is used inside the smooth objective fct
+        L = self._getL(nc)[0] # L is used inside the smooth objective fct
         # each constrain is proportional to the distance between the centroid of the two layers
         if nd > 1:
             centroids = np.r_[depths0[0]/2, depths0[:-1] + np.diff(depths0)/2]
@@ -645,9 +738,16 @@ class Problem(object):
         
         # model misfit only for conductivities not depths
         def modelMisfit(p):
-            cond = p[:np.sum(vc)] # smoothing only for parameters elements (depth or cond)
+            cond = p[:nvc] # smoothing only for parameters elements (depth or cond)
             return cond[:-1] - cond[1:]
         
+        # squared l2 norm of the model misfit as a quadratic form, as
+        # buildSecondDiff() is D.T @ D with D the difference of modelMisfit()
+        LD = self._getL(nvc)[0] if nvc > 1 else np.zeros((nvc, nvc))
+        def modelMisfitL2(p):
+            cond = p[:nvc]
+            return np.dot(cond, np.dot(LD, cond))
+        
         # set up regularisation
         # p : parameter, app : ECa,
         # pn : consecutive previous profile (for lateral smoothing)
@@ -655,16 +755,170 @@ class Problem(object):
         if regularization  == 'l1':
             def objfunc(p, app, pn, spn, alpha, beta, gamma, ini0):
                 return np.sqrt(np.sum(np.abs(dataMisfit(p, app, ini0)))/len(app)
-                               + alpha*np.sum(np.abs(modelMisfit(p)))/np.sum(vc)
+                               + alpha*np.sum(np.abs(modelMisfit(p)))/nvc
                                + beta*np.sum(np.abs(p - pn))/len(p)
                                + gamma*np.sum(np.abs(p - spn))/len(p))
         elif regularization == 'l2':
             def objfunc(p, app, pn, spn, alpha, beta, gamma, ini0):
                 return np.sqrt(np.sum(dataMisfit(p, app, ini0)**2)/len(app)
-                               + alpha*np.sum(modelMisfit(p)**2)/np.sum(vc)
+                               + alpha*modelMisfitL2(p)/nvc
                                + beta*np.sum((p - pn)**2)/len(p)
                                + gamma*np.sum((p - spn)**2)/len(p))
-            
+
+        # l2 objective function and its gradient for gradient-based solvers,
+        # the Jacobian of the forward model is analytical for CS with fixed
+        # depths (linear) and computed by finite difference otherwise, all
+        # perturbations being evaluated in a single call to fmodelBatch()
+        def fmodelJacobian(p, ini0): # returns forward response, Ncoils x Nparam Jacobian
+            if forwardModel == 'CS' and nvd == 0:
+                depth = ini0[0]
+                cond = ini0[1].copy()
+                cond[vc] = p
+                K = self._buildKernelCS(depth)
+                return np.dot(K, cond), K[:,vc]
+            # FSeq response is found by root finding so it's only accurate to
+            # the solver tolerance and needs a larger step
+            step = 1e-4 if forwardModel == 'FSeq' else np.sqrt(np.finfo(float).eps)
+            h = step*np.maximum(1, np.abs(p))
+            P = p + np.r_[np.zeros((1, len(p))), np.diag(h)]
+            ini0s = (np.tile(ini0[0], (len(p)+1, 1)), np.tile(ini0[1], (len(p)+1, 1)))
+            apps = fmodelBatch(P, ini0s)
+            return apps[0,:], ((apps[1:,:] - apps[0,:])/h[:,None]).T
+
+        # batched version of the above for all profiles at once (vectorized
+        # inversion, CS only), returns the Nprofile x Ncoils forward responses
+        # and Nprofile x Ncoils x Nparam Jacobians
+        def fmodelJacobianBatch(P, ini0s):
+            nrow, npar = P.shape
+            if forwardModel == 'CS' and nvd == 0:
+                conds = ini0s[1].copy()
+                conds[:,vc] = P
+                # profiles usually share the same depths so kernels are only
+                # built once per set of depths
+                udepths, iunique = np.unique(ini0s[0], axis=0, return_inverse=True)
+                Ks = np.array([self._buildKernelCS(d) for d in udepths])[iunique.ravel()]
+                return np.einsum('ijk,ik->ij', Ks, conds), Ks[:,:,vc]
+            h = np.sqrt(np.finfo(float).eps)*np.maximum(1, np.abs(P))
+            dP = np.concatenate([np.zeros((nrow, 1, npar)), h[:,:,None]*np.eye(npar)], axis=1)
+            ini0ss = (np.repeat(ini0s[0], npar+1, axis=0), np.repeat(ini0s[1], npar+1, axis=0))
+            apps = fmodelBatch((P[:,None,:] + dP).reshape((-1, npar)), ini0ss)
+            apps = apps.reshape((nrow, npar+1, -1))
+            return apps[:,0,:], ((apps[:,1:,:] - apps[:,:1,:])/h[:,:,None]).transpose(0, 2, 1)
+
+        objfuncGrad = None
+        if regularization == 'l2' and forwardModel in ['CS', 'FSlin', 'FSeq']:
+            def objfuncGrad(p, app, pn, spn, alpha, beta, gamma, ini0):
+                fwd, J = fmodelJacobian(p, ini0)
+                misfit = fwd - app
+                val = np.sqrt(np.sum(misfit**2)/len(app)
+                              + alpha*modelMisfitL2(p)/nvc
+                              + beta*np.sum((p - pn)**2)/len(p)
+                              + gamma*np.sum((p - spn)**2)/len(p))
+                grad = (2*np.dot(J.T, misfit)/len(app)
+                        + 2*beta*(p - pn)/len(p)
+                        + 2*gamma*(p - spn)/len(p))
+                grad[:nvc] += 2*alpha*np.dot(LD, p[:nvc])/nvc
+                if val > 0: # d(sqrt(x)) = dx/(2*sqrt(x))
+                    grad = grad/(2*val)
+                return val, grad
+
+        # compiled objective function (and its gradient for L-BFGS-B, TNC and
+        # CG) when all conductivities are CS parameters
+        if (GOT_NUMBA and forwardModel == 'CS' and regularization == 'l2'
+                and nvd == 0 and nvc == nc):
+            cspacing = np.array(self.cspacing, dtype=float)
+            cposi = np.array([dicoCpos[a] for a in self.cpos])
+            hx = np.array(self.hx, dtype=float)
+            def objfunc(p, app, pn, spn, alpha, beta, gamma, ini0):
+                return objfuncCSnumba(p, app, pn, spn, ini0[0], cspacing, cposi,
+                                      hx, float(alpha), float(beta), float(gamma))
+            def objfuncGrad(p, app, pn, spn, alpha, beta, gamma, ini0):
+                return objfuncGradCSnumba(p, app, pn, spn, ini0[0], cspacing, cposi,
+                                          hx, float(alpha), float(beta), float(gamma))
+
+        # vector of residuals of the l2 objective function for least_squares(),
+        # 0.5*sum(residuals(p)**2) is 0.5*objfunc(p)**2 so the minimum is the same
+        def residuals(p, app, pn, spn, alpha, beta, gamma, ini0):
+            return np.r_[dataMisfit(p, app, ini0)/np.sqrt(len(app)),
+                         np.sqrt(alpha/nvc)*modelMisfit(p),
+                         np.sqrt(beta/len(p))*(p - pn),
+                         np.sqrt(gamma/len(p))*(p - spn)]
+
+        residualsJac = '2-point'
+        if forwardModel in ['CS', 'FSlin', 'FSeq']:
+            npar = nvd + nvc
+            ndiff = max(nvc - 1, 0)
+            D = np.eye(ndiff, npar) - np.eye(ndiff, npar, k=1) # Jacobian of modelMisfit()
+            def residualsJac(p, app, pn, spn, alpha, beta, gamma, ini0):
+                J = fmodelJacobian(p, ini0)[1]
+                return np.r_[J/np.sqrt(len(app)),
+                             np.sqrt(alpha/nvc)*D,
+                             np.sqrt(beta/len(p))*np.eye(len(p)),
+                             np.sqrt(gamma/len(p))*np.eye(len(p))]
+
+        # least_squares() needs the bounds as (lower, upper) arrays and takes
+        # its settings as keyword arguments instead of an options dictionary
+        if method == 'lsq':
+            lsqBounds = (-np.inf, np.inf)
+            if bounds is not None:
+                lower, upper = np.array(bounds, dtype=float).T # None (no bound) becomes NaN
+                lsqBounds = (np.where(np.isnan(lower), -np.inf, lower),
+                             np.where(np.isnan(upper), np.inf, upper))
+            lsqOptions = dict(options)
+            if 'maxiter' in lsqOptions:
+                lsqOptions['max_nfev'] = lsqOptions.pop('maxiter')
+            if 'disp' in lsqOptions:
+                lsqOptions['verbose'] = int(lsqOptions.pop('disp'))
+            lsqKeys = ['ftol', 'xtol', 'gtol', 'x_scale', 'loss', 'f_scale', 'diff_step',
+                       'tr_solver', 'tr_options', 'max_nfev', 'verbose']
+            unknown = [key for key in lsqOptions if key not in lsqKeys]
+            if len(unknown) > 0:
+                raise ValueError('Options {:s} are not supported by lsq, use: {:s}.'.format(
+                    ', '.join(unknown), ', '.join(['maxiter', 'disp'] + lsqKeys)))
+
+        # batched version of the above for the vectorized inversion (CS only),
+        # returns one objective value per profile
+        def dataMisfitBatch(P, obss, ini0s):
+            return fmodelBatch(P, ini0s) - obss
+
+        def modelMisfitBatch(P):
+            cond = P[:,:nvc]
+            return cond[:,:-1] - cond[:,1:]
+
+        def modelMisfitL2Batch(P):
+            cond = P[:,:nvc]
+            return np.sum(np.dot(cond, LD)*cond, axis=1)
+
+        if regularization == 'l1':
+            def objfuncBatch(P, obss, pns, spns, alpha, beta, gamma, ini0s):
+                return np.sqrt(np.sum(np.abs(dataMisfitBatch(P, obss, ini0s)), axis=1)/obss.shape[1]
+                               + alpha*np.sum(np.abs(modelMisfitBatch(P)), axis=1)/nvc
+                               + beta*np.sum(np.abs(P - pns), axis=1)/P.shape[1]
+                               + gamma*np.sum(np.abs(P - spns), axis=1)/P.shape[1])
+        elif regularization == 'l2':
+            def objfuncBatch(P, obss, pns, spns, alpha, beta, gamma, ini0s):
+                return np.sqrt(np.sum(dataMisfitBatch(P, obss, ini0s)**2, axis=1)/obss.shape[1]
+                               + alpha*modelMisfitL2Batch(P)/nvc
+                               + beta*np.sum((P - pns)**2, axis=1)/P.shape[1]
+                               + gamma*np.sum((P - spns)**2, axis=1)/P.shape[1])
+
+        objfuncGradBatch = None
+        if regularization == 'l2':
+            def objfuncGradBatch(P, obss, pns, spns, alpha, beta, gamma, ini0s):
+                fwd, J = fmodelJacobianBatch(P, ini0s)
+                misfit = fwd - obss
+                nobs, npar = obss.shape[1], P.shape[1]
+                val = np.sqrt(np.sum(misfit**2, axis=1)/nobs
+                              + alpha*modelMisfitL2Batch(P)/nvc
+                              + beta*np.sum((P - pns)**2, axis=1)/npar
+                              + gamma*np.sum((P - spns)**2, axis=1)/npar)
+                grad = (2*np.einsum('ijk,ij->ik', J, misfit)/nobs
+                        + 2*beta*(P - pns)/npar
+                        + 2*gamma*(P - spns)/npar)
+                grad[:,:nvc] += 2*alpha*np.dot(P[:,:nvc], LD)/nvc
+                grad = grad/np.where(val > 0, 2*val, 1)[:,None] # d(sqrt(x)) = dx/(2*sqrt(x))
+                return val, grad
+
         # define spotpy class if McMC-based methods
         if method in mMCMC:
             try:
@@ -718,9 +972,23 @@ class Problem(object):
                 raise ValueError('killed') # https://github.com/joblib/joblib/issues/356
             if method in mMinimize: # minimize
                 x0 = np.r_[ini0[0][vd], ini0[1][vc]]
-                res = minimize(objfunc, x0, args=(obs, pn, spn, alpha, beta, gamma, ini0),
-                               method=method, bounds=bounds, options=options)
-                out = res.x  
+                if method == 'lsq':
+                    x0 = np.clip(x0, *lsqBounds) # x0 must be feasible
+                    if np.all(np.isfinite(obs)):
+                        res = least_squares(residuals, x0, jac=residualsJac, bounds=lsqBounds,
+                                            method='trf', args=(obs, pn, spn, alpha, beta, gamma, ini0),
+                                            **lsqOptions)
+                        out = res.x
+                    else: # missing ECa, the profile stays at the initial model as with minimize()
+                        out = x0
+                elif objfuncGrad is not None and method != 'Nelder-Mead':
+                    res = minimize(objfuncGrad, x0, args=(obs, pn, spn, alpha, beta, gamma, ini0),
+                                   jac=True, method=method, bounds=bounds, options=options)
+                    out = res.x
+                else:
+                    res = minimize(objfunc, x0, args=(obs, pn, spn, alpha, beta, gamma, ini0),
+                                   method=method, bounds=bounds, options=options)
+                    out = res.x
             elif method in mMCMC: # MCMC based methods
                 spotpySetup = spotpy_setup(obs, bounds, pn, spn, alpha, beta, 
                                            gamma, ini0, fmodel)
@@ -795,29 +1063,93 @@ class Problem(object):
                 # fig.tight_layout()
                 # fig.savefig('figures/mcmc.jpg', dpi=500)
                 # fig.show()
-                                
+
+            return out
+
+        # define vectorized optimization function (all profiles at once)
+        def solveBatch(obss, pns, spns, alpha, beta, gamma, ini0s):
+            if self.ikill is True:
+                raise ValueError('killed')
+            x0 = np.c_[ini0s[0][:,vd], ini0s[1][:,vc]]
+            out = x0.astype(float)
+            # a profile with missing ECa would make the summed objective NaN,
+            # it stays at the initial model as in the row by row inversion
+            ifinite = np.isfinite(obss).all(axis=1)
+            if not ifinite.any():
+                return out
+            nrow, nparam = np.sum(ifinite), x0.shape[1]
+            args = (obss[ifinite], pns[ifinite], spns[ifinite], alpha, beta, gamma,
+                    (ini0s[0][ifinite], ini0s[1][ifinite]))
+            def fun(x):
+                P = x.reshape((nrow, nparam))
+                if objfuncGradBatch is not None:
+                    f0, grad = objfuncGradBatch(P, *args)
+                    return np.sum(f0), grad.flatten()
+                f0 = objfuncBatch(P, *args)
+                # each profile only depends on its own parameters, so perturbing
+                # the same parameter of all profiles at once gives the full gradient
+                # in nparam evaluations of the batched objective function
+                grad = np.zeros((nrow, nparam))
+                for l in range(nparam):
+                    h = np.sqrt(np.finfo(float).eps)*np.maximum(1, np.abs(P[:,l]))
+                    Pl = P.copy()
+                    Pl[:,l] = Pl[:,l] + h
+                    grad[:,l] = (objfuncBatch(Pl, *args) - f0)/h
+                return np.sum(f0), grad.flatten()
+            # the relative decrease of the objective (ftol) is measured on the sum
+            # of nrow objectives so it is divided by nrow to not stop before the
+            # profiles would individually converge (gtol applies to each component
+            # of the gradient which are the same as the ones of each profile)
+            batchOptions = dict(options)
+            if method == 'L-BFGS-B':
+                batchOptions['ftol'] = options.get('ftol', 2.220446049250313e-09)/nrow
+            res = minimize(fun, out[ifinite].flatten(), jac=True, method=method,
+                           bounds=None if bounds is None else list(bounds)*nrow,
+                           options=batchOptions)
+            out[ifinite] = res.x.reshape((nrow, nparam))
             return out
+
+        # define optimization function for a chunk of consecutive profiles,
+        # the lateral constrain is taken from the previous solution in the chunk
+        def solveChunk(chunk):
+            outs = []
+            for k, a in enumerate(chunk):
+                obs, pn, spn, alpha, b, g, ini0 = a
+                if k == 0: # no previous solution in this chunk
+                    b = 0
+                else:
+                    pn = outs[-1][0] if method in mMCMC else outs[-1]
+                outs.append(solve(obs, pn, spn, alpha, b, g, ini0))
+            return outs
+
+        gnCache = {} # Jacobian and factorized LHS for Gauss-Newton
         
         # inversion row by row
         for i, survey in enumerate(self.surveys):
             if self.ikill:
                 break
             self.c = 0
-            apps = survey.df[self.coils].values # ECa in mS/m
+            apps = survey.getApps(self.coils, dtype=self.dtype) # ECa in mS/m
             inph = survey.df[self.coilsInph].values # inphase in ppt
             rmse = np.zeros(apps.shape[0])*np.nan
             model = self.conds0[i].copy()
             depth = self.depths0[i].copy()
-            stds = np.zeros((apps.shape[0], np.sum(vd) + np.sum(vc)))
+            stds = np.zeros((apps.shape[0], nvd + nvc))
             xy = self.surveys[i].df[['x','y']].values
             iinverted = np.zeros(apps.shape[0], dtype=bool)
             dist0 = np.sqrt(np.sum((xy - xy[0,:])**2, axis=1))
             iorder = np.argsort(dist0)
-            if len(self.surveys) > 1: # if only one survey, this isn't needed
-                dump('\nSurvey {:d}/{:d}\n'.format(i+1, len(self.surveys)))
             params = []
             outs = []
             nrows = survey.df.shape[0]
+            # progress is only reported every 1% of the rows as dump() can
+            # be expensive (e.g. redrawing the log in the GUI)
+            ndump = max(1, nrows//100)
+            header = ''
+            if len(self.surveys) > 1: # if only one survey, this isn't needed
+                header = 'Survey {:d}/{:d}: '.format(i+1, len(self.surveys))
+                if i > 0:
+                    dump('\n')
             for j in range(nrows):
                 # define observations and convert to Q if needed
                 obs = apps[j,:]
@@ -829,10 +1161,11 @@ class Problem(object):
                     
                 # define previous profile in case we want to lateral constrain
                 if j == 0:
-                    pn = np.zeros(np.sum(np.r_[vd, vc]))
+                    pn = np.zeros(nvd + nvc)
                     b = 0
                     iinverted[j] = True
                 else:
+                    b = beta
                     if threed: # mean of 3 closest inverted survey
                         ipt = iorder[j]
                         dist = np.sqrt(np.sum((xy-xy[ipt,:])**2, axis=1))
@@ -846,7 +1179,7 @@ class Problem(object):
                     
                 # define profile from previous survey for time-lapse constrain
                 if i == 0 or gamma == 0:
-                    spn = np.zeros(np.sum(np.r_[vd, vc]))
+                    spn = np.zeros(nvd + nvc)
                     g = 0
                 else: # constrain to the first inverted survey
                     spn = np.r_[self.depths[0][j,:][vd], self.models[0][j,:][vc]]
@@ -858,11 +1191,12 @@ class Problem(object):
                 params.append((obs, pn, spn, alpha, b, g, ini0))                
             
                 # sequential inversion (default)
-                if (method not in mOther) & (njobs == 1):
+                if (method not in mOther) & (njobs == 1) & (not vectorized):
                     try:
                         with HiddenPrints():
                             outt = solve(*params[j])
-                        dump('\r{:d}/{:d} inverted'.format(j+1, nrows))
+                        if (j+1) % ndump == 0 or j+1 == nrows:
+                            dump('\r{:s}{:d}/{:d} inverted'.format(header, j+1, nrows))
                         obs = params[j][0]
                         ini0 = params[j][-1]
                         if method in mMCMC:
@@ -871,8 +1205,8 @@ class Problem(object):
                             out = outt[0]
                         else:
                             out = outt
-                        depth[j,vd] = out[:np.sum(vd)]
-                        model[j,vc] = out[np.sum(vd):]
+                        depth[j,vd] = out[:nvd]
+                        model[j,vc] = out[nvd:]
                         if forwardModel == 'QP':
                             obs = np.sqrt(np.imag(obs)**2 + 1e-9*np.real(obs)**2)
                         rmse[j] = np.sqrt(np.sum((dataMisfit(out, obs, ini0)/obs)**2)/len(obs))*100
@@ -882,14 +1216,24 @@ class Problem(object):
                     
                 if method == 'Gauss-Newton':
                     try:
-                        dump('\r{:d}/{:d} inverted'.format(j+1, nrows))
-                        # compute Jacobian
-                        sens = self.computeSens(forwardModel=forwardModel,
-                                                coils=None, # this trigger normal forward modelling
-                                                models=[ini0[1][None,:]], depths=[ini0[0][None,:]])
-                        sens = sens[0][:,:,0]
-                        J = sens/np.sum(sens, axis=0) # so that sum == 1
-                        J = J.T
+                        if (j+1) % ndump == 0 or j+1 == nrows:
+                            dump('\r{:s}{:d}/{:d} inverted'.format(header, j+1, nrows))
+                        if not np.isfinite(obs).all(): # missing ECa, profile not inverted
+                            model[j,vc] = np.nan
+                            continue
+                        # compute Jacobian and factorize the left hand side, they
+                        # only depend on the initial model so they are reused
+                        # for all iterations and all profiles with the same one
+                        key = (ini0[0].tobytes(), ini0[1].tobytes())
+                        if key not in gnCache:
+                            sens = self.computeSens(forwardModel=forwardModel,
+                                                    coils=None, # this trigger normal forward modelling
+                                                    models=[ini0[1][None,:]], depths=[ini0[0][None,:]])
+                            sens = sens[0][:,:,0]
+                            J = sens/np.sum(sens, axis=0) # so that sum == 1
+                            J = J.T
+                            gnCache[key] = (J, factorize(np.dot(J.T, J) + alpha*L))
+                        J, solveLHS = gnCache[key]
 
                         # Gauss-Newton algorithm
                         cond = np.copy(ini0[1])[:,None]
@@ -900,16 +1244,15 @@ class Problem(object):
                         maxiter = options['maxiter'] if 'maxiter' in options else 3
                         for l in range(maxiter): # only one iteration as the jacobian doesn't depend on the cond
                             d = -dataMisfit(cond.flatten(), app, ini0) # NOTE we need minus to get the right direction
-                            LHS = np.dot(J.T, J) + alpha*L
                             RHS = np.dot(J.T, d[:,None]) - alpha*np.dot(L, cond)
-                            solution = np.linalg.solve(LHS, RHS)
+                            solution = solveLHS(RHS)
                             cond = cond + solution
                             out = cond.flatten()
                             # rrmse = np.sqrt(1/len(app)*np.sum(dataMisfit(out, app, ini0)**2)/np.sum(app**2))
                             # print('{:d}: RMSE: {:.5f}%'.format(l, rrmse), ' '.join(
                                 # ['{:.2f}'.format(a) for a in cond[:,0]]))
-                        depth[j,vd] = out[:np.sum(vd)]
-                        model[j,vc] = out[np.sum(vd):]
+                        depth[j,vd] = out[:nvd]
+                        model[j,vc] = out[nvd:]
                         if forwardModel == 'QP':
                             obs = np.sqrt(np.real(obs)**2 + np.imag(obs)**2)
                         rmse[j] = np.sqrt(np.sum((dataMisfit(out, obs, ini0)/obs)**2)/len(obs))*100
@@ -917,11 +1260,34 @@ class Problem(object):
                         print('Killed')
                         return
             
+            # vectorized inversion by batch of profiles
+            if vectorized:
+                nbatch = 100
+                outs = []
+                try:
+                    for j in range(0, nrows, nbatch):
+                        batch = params[j:j+nbatch]
+                        obss, pns, spns = [np.vstack([a[k] for a in batch]) for k in range(3)]
+                        ini0s = (np.vstack([a[-1][0] for a in batch]),
+                                 np.vstack([a[-1][1] for a in batch]))
+                        with HiddenPrints():
+                            outs.extend(solveBatch(obss, pns, spns, alpha, 0, batch[0][5], ini0s))
+                        dump('\r{:s}{:d}/{:d} inverted'.format(header, len(outs), nrows))
+                except Exception as e:
+                    print('Killed')
+                    return
+
             # parallel computing with loky backend
-            if (method != 'ANN') & (njobs != 1):
+            elif (method != 'ANN') & (njobs != 1):
                 try:
                     with HiddenPrints():
-                        outs = Parallel(n_jobs=njobs, verbose=0, backend='loky')(delayed(solve)(*a) for a in tqdm(params))
+                        if beta != 0: # contiguous chunks to keep the lateral constrain
+                            chunks = np.array_split(np.arange(nrows), effective_n_jobs(njobs))
+                            outs = Parallel(n_jobs=njobs, verbose=0, backend='loky')(
+                                delayed(solveChunk)(params[c[0]:c[-1]+1]) for c in tqdm(chunks) if len(c) > 0)
+                            outs = [out for chunk in outs for out in chunk]
+                        else:
+                            outs = Parallel(n_jobs=njobs, verbose=0, backend='loky')(delayed(solve)(*a) for a in tqdm(params))
                 except Exception as e: # might be when we kill it using UI
                     print('Error in // inversion:', e)
                     return
@@ -951,7 +1317,7 @@ class Problem(object):
                 outs = list(outs)
 
             # store results from optimization
-            if (method == 'ANN') or (njobs != 1):
+            if (method == 'ANN') or (njobs != 1) or vectorized:
                 for j, outt in enumerate(outs):
                     obs = params[j][0]
                     if method in mMCMC:
@@ -960,17 +1326,51 @@ class Problem(object):
                         out = outt[0]
                     else:
                         out = outt
-                    depth[j,vd] = out[:np.sum(vd)]
-                    model[j,vc] = out[np.sum(vd):]
+                    depth[j,vd] = out[:nvd]
+                    model[j,vc] = out[nvd:]
                     rmse[j] = np.sqrt(np.sum((dataMisfit(out, obs, params[j][-1])/obs)**2)/len(obs))*100
-            self.models.append(model)
-            self.depths.append(depth)
-            self.misfits.append(rmse)
-            self.pstds.append(stds)
+            self.models.append(model.astype(self.dtype))
+            self.depths.append(depth.astype(self.dtype))
+            self.misfits.append(rmse.astype(self.dtype))
+            self.pstds.append(stds.astype(self.dtype))
             # dump('{:d} measurements inverted\n'.format(apps.shape[0]))
                     
             
     
+    def _buildKernelCS(self, depths):
+        """Returns the kernel matrix K (Ncoils x Nlayers) of the CS forward
+        model so that the apparent conductivities are `np.dot(K, cond)`.
+        The matrix only depends on the depths and the coils geometry so it
+        is cached for these parameters.
+        
+        Parameters
+        ----------
+        depths : array
+            Depths of the bottom of each layer (without the leading 0).
+        """
+        depths = np.asarray(depths, dtype=float)
+        key = (depths.tobytes(), tuple(self.cspacing), tuple(self.cpos), tuple(self.hx))
+        if key not in self._kernelCache:
+            self._kernelCache[key] = buildJacobian(depths, self.cspacing, self.cpos, hx=self.hx)
+        return self._kernelCache[key]
+    
+    
+    def _getL(self, n):
+        """Returns the roughness matrix L (n x n) from `buildSecondDiff()`
+        and L.T @ L. Both are cached for each size and must not be modified
+        in place.
+        
+        Parameters
+        ----------
+        n : int
+            Number of parameters.
+        """
+        if n not in self._LCache:
+            L = buildSecondDiff(n)
+            self._LCache[n] = (L, np.dot(L.T, L))
+        return self._LCache[n]
+        
+    
     def buildANN(self, fmodel, bounds, noise=0.05, iplot=False, nsample=100,
                  dump=None, epochs=500): # pragma: no cover
         """Build and train the artificial neural network on synthetic values
@@ -1150,44 +1550,37 @@ class Problem(object):
                 print(x, end='')
                 
         J = buildJacobian(depths0, self.cspacing, self.cpos)
-        L = buildSecondDiff(J.shape[1])
-        def fmodel(p):
-            return fCS(p, depths0, self.cspacing, self.cpos, hx=self.hx)
-        
-        # fCS is automatically adding a leading 0 but not buildJacobian
-        def dataMisfit(p, app):
-            return app - fmodel(p)
-        def modelMisfit(p):
-            return np.dot(L, p)
+        L = self._getL(J.shape[1])[0]
+        K = self._buildKernelCS(depths0).astype(self.dtype)
+        def fmodel(P): # P is Nprofile x Nlayer
+            return np.dot(P, K.T)
+        
+        # J and L are the same for all profiles so the left hand side is
+        # factorized once and all profiles are solved in a single call
+        LHS = np.dot(J.T, J) + alpha*L
+        if alpha_ref is not None: # constrain the change of the last element of the profile
+            LHS[-1:,-1:] = alpha_ref
+        solveLHS = factorize(LHS) # Cholesky as LHS is symmetric positive definite
         
         for i, survey in enumerate(self.surveys):
-            apps = survey.df[self.coils].values
-            rmse = np.zeros(apps.shape[0])*np.nan
-            model = np.zeros((apps.shape[0], len(conds0)))*np.nan
-            dump('Survey {:d}/{:d}\n'.format(i+1, len(self.surveys)))
-            for j in range(survey.df.shape[0]):
-                app = apps[j,:]
-                cond = np.ones((len(conds0),1))*np.nanmean(app) # initial EC is the mean of the apparent (doesn't matter)
-                # OR search for best starting model here
-                for l in range(1): # only one iteration as the jacobian doesn't depend on the cond
-                    d = dataMisfit(cond, app)
-                    LHS = np.dot(J.T, J) + alpha*L
-                    RHS = np.dot(J.T, d[:,None]) - alpha*np.dot(L, cond) # minus or plus doesn't matter here ?!
-                    if alpha_ref is not None: # constrain the change of the last element of the profile
-                        LHS[-1:,-1:] = alpha_ref
-                        RHS[-1:] = alpha_ref*cond[i,-1]
-                    solution = np.linalg.solve(LHS, RHS)
-                    cond = cond + solution # it's an iterative process but it converges in one iteration as it's linear
-                out = cond.flatten()
-                model[j,:] = out
-                rmse[j] = np.sqrt(np.sum((dataMisfit(out, app)/app)**2)/len(app))*100
-                dump('\r{:d}/{:d} inverted'.format(j+1, apps.shape[0]))
+            apps = survey.getApps(self.coils, dtype=self.dtype)
+            # initial EC is the mean of the apparent (doesn't matter)
+            conds = np.ones((apps.shape[0], len(conds0)), dtype=self.dtype)*np.nanmean(apps, axis=1)[:,None]
+            # only one iteration as the jacobian doesn't depend on the cond
+            d = apps - fmodel(conds) # fCS is automatically adding a leading 0 but not buildJacobian
+            RHS = np.dot(J.T, d.T) - alpha*np.dot(L, conds.T) # Nlayer x Nprofile
+            if alpha_ref is not None:
+                RHS[-1:,:] = alpha_ref*conds.T[-1:,:]
+            # the system is solved in float64 (RHS is upcasted by J)
+            model = (conds + solveLHS(RHS).T).astype(self.dtype) # it converges in one iteration as it's linear
+            rmse = np.sqrt(np.sum(((apps - fmodel(model))/apps)**2, axis=1)/apps.shape[1])*100
             self.models.append(model)
             self.misfits.append(rmse)
-            depth = np.repeat(depths0[None,:], apps.shape[0], axis=0)
+            depth = np.repeat(depths0[None,:], apps.shape[0], axis=0).astype(self.dtype)
             self.depths.append(depth)
-            self.pstds.append(np.zeros(model.shape))
-            dump('\n')
+            self.pstds.append(np.zeros(model.shape, dtype=self.dtype))
+            dump('Survey {:d}/{:d}: {:d}/{:d} inverted\n'.format(
+                i+1, len(self.surveys), apps.shape[0], apps.shape[0]))
            
 
 
@@ -1437,22 +1830,22 @@ class Problem(object):
         if forwardModel == 'Q':
             print('For the Q forward model, the ECa values will be computed using FSeq')
             forwardModel = 'FSeq'
-        if forwardModel in ['CS','FSlin','FSeq']:
+        if forwardModel in ['CS','FSlin','FSeq']: # all profiles at once
             if forwardModel == 'CS':
-                def fmodel(p, depth):
-                    return fCS(p, depth, cspacing, cpos, hx=hxs)
+                def fmodel(P, depth):
+                    return fCSbatch(P, depth, cspacing, cpos, hx=hxs)
             elif forwardModel == 'FSlin':
-                def fmodel(p, depth):
-                    return fMaxwellECa(p, depth, cspacing, cpos, f=freqs, hx=hxs)
+                def fmodel(P, depth):
+                    return fMaxwellECabatch(P, depth, cspacing, cpos, f=freqs, hx=hxs)
             elif forwardModel == 'FSeq':
-                def fmodel(p, depth):
-                    return fMaxwellQ(p, depth, cspacing, cpos, f=freqs, hx=hxs)
+                def fmodel(P, depth):
+                    return fMaxwellQbatch(P, depth, cspacing, cpos, f=freqs, hx=hxs)
         else:
             raise ValueError('Forward model {:s} is not available.'
                              'Choose between CS, FSlin or FSeq'.format(forwardModel))
         
         def addnoise(x, level=0.05):
-            return x + np.random.randn(len(x))*x*level
+            return x + np.random.randn(*x.shape)*x*level
         
         if len(models) == 0:
             models = self.models
@@ -1460,11 +1853,7 @@ class Problem(object):
             depths = self.depths
         dfs = []
         for model, depth in zip(models, depths):
-            apps = np.zeros((model.shape[0], len(self.coils)))*np.nan
-            for j in range(model.shape[0]):
-                conds = model[j,:]
-                sdepth = depth[j,:]
-                apps[j,:] = addnoise(fmodel(conds, sdepth), level=noise)
+            apps = addnoise(fmodel(model, depth), level=noise).astype(self.dtype)
         
             df = pd.DataFrame(apps, columns=self.coils)
             dfs.append(df)
@@ -1653,7 +2042,7 @@ class Problem(object):
         doe = mdepths[idoe]
         
         # figure
-        eca = self.surveys[index].df[self.coils].values.flatten()
+        eca = self.surveys[index].getApps(self.coils).flatten()
         x = self.surveys[index].df['x'].values
         y = self.surveys[index].df['y'].values
         if dist:
@@ -1816,10 +2205,11 @@ class Problem(object):
         tt = tOffsetScaling
         
         if color == True:
+            zmin, zmax = percentile(Z, [2, 98])
             if vmin is None:
-                vmin = np.nanpercentile(Z.flatten(), 2)
+                vmin = zmin
             if vmax is None:
-                vmax = np.nanpercentile(Z.flatten(), 98)
+                vmax = zmax
             norm = plt.Normalize(vmin=vmin, vmax=vmax)
             Z = plt.get_cmap(cmap, nlevel)(norm(Z))
             Z = 255*Z
@@ -2213,19 +2603,25 @@ class Problem(object):
             fig, ax = plt.subplots()
         else:
             fig = ax.figure        
-        if depths[0,0] != 0: # add depth 0
-            depths = np.c_[np.zeros(depths.shape[0]), depths]
+        # layer boundaries (from 0 to maxDepth) filled in a single array
+        itop = int(depths[0,0] != 0) # add depth 0
+        bounds = np.empty((depths.shape[0], depths.shape[1] + itop + 1))
+        bounds[:,0] = 0
+        bounds[:,itop:-1] = depths
+        depths = bounds
+        smin, smax = percentile(sig, [5, 95])
         if vmin is None:
-            vmin = np.nanpercentile(sig, 5)
+            vmin = smin
         if vmax is None:
-            vmax = np.nanpercentile(sig, 95)
+            vmax = smax
         cmap = plt.get_cmap(cmap)
-        if maxDepth is None or maxDepth >= np.max(depths):
+        if maxDepth is None or maxDepth >= np.max(depths[:,:-1]):
             padding = 1
-            maxDepth = np.nanpercentile(depths, 98) + padding
-        depths = -np.c_[depths, np.ones(depths.shape[0])*maxDepth]
+            maxDepth = percentile(depths[:,:-1], 98) + padding
+        depths[:,-1] = maxDepth
+        np.negative(depths, out=depths)
         if elev:
-            depths = depths + self.surveys[index].df['elevation'].values[:,None]
+            depths += self.surveys[index].df['elevation'].values[:,None]
         if dist:
             if len(self.surveys) == 0:
                 dist = False # no survey to take position from
@@ -2242,17 +2638,19 @@ class Problem(object):
             distance = np.r_[[0], distance, distance[[-1]]]
             x = np.cumsum(distance)
 
-        xs = np.tile(np.repeat(x, 2)[1:-1][:,None], nlayer+1)
-        ys = np.repeat(depths, 2, axis=0)
-        vertices = np.c_[xs.flatten('F'), ys.flatten('F')]
+        # cells coordinates (Nlayer*Nsample x 4 x 2), layer by layer
+        xl = np.broadcast_to(x[:-1], (nlayer, nsample))
+        xr = np.broadcast_to(x[1:], (nlayer, nsample))
+        ztop = depths[:,:-1].T
+        zbot = depths[:,1:].T
+        coordinates = np.stack([np.stack([xl, ztop], axis=-1),
+                                np.stack([xr, ztop], axis=-1),
+                                np.stack([xr, zbot], axis=-1),
+                                np.stack([xl, zbot], axis=-1)], axis=2).reshape((-1, 4, 2))
         
-        # connection matrix
-        n = vertices.shape[0]
-        connection = np.c_[np.arange(n).reshape(-1,2),
-                           2*nsample + np.arange(n).reshape(-1,2)[:,::-1]]
-        ie = (connection >= len(vertices)).any(axis=1)
-        connection = connection[~ie, :]
-        coordinates = vertices[connection]
+        # if all profiles have the same depths, a single QuadMesh is much
+        # faster to draw than one polygon per cell
+        uniform = (depths == depths[0,:]).all()
         
         # plotting
         if contour is True:
@@ -2283,9 +2681,12 @@ class Problem(object):
     
             fig.colorbar(cax, ax=ax, label='EC [mS/m]')
         else:
-            coll = PolyCollection(coordinates, array=sig.flatten('F'), cmap=cmap)
+            if uniform:
+                coll = ax.pcolormesh(x, depths[0,:], sig.T, cmap=cmap)
+            else:
+                coll = PolyCollection(coordinates, array=sig.flatten('F'), cmap=cmap)
+                ax.add_collection(coll)
             coll.set_clim(vmin=vmin, vmax=vmax)
-            ax.add_collection(coll)
             pad = 0.15 if rmse else 0.05
             fig.colorbar(coll, label='EC [mS/m]', ax=ax, pad=pad)
         
@@ -2318,6 +2719,8 @@ class Problem(object):
                 zc = np.c_[zu[:,0], zu, zu[:,-1]]
                 cax = ax.tricontourf(xc, yc, zc.flatten('F'),
                                      cmap=acmap, extend='both')
+            elif uniform:
+                ax.pcolormesh(x, depths[0,:], zu.T, cmap=acmap)
             else:
                 coll = PolyCollection(coordinates, array=zu.flatten('F'), cmap=acmap)
                 ax.add_collection(coll)
@@ -2488,7 +2891,7 @@ class Problem(object):
         nsample = xy.shape[0]
         padding = 1
         if maxDepth is None:
-            maxDepth = np.nanpercentile(depths, 98) + padding
+            maxDepth = percentile(depths, 98) + padding
         depths = -np.c_[np.zeros(nsample), depths, np.ones(depths.shape[0])*maxDepth]
         if elev:
             depths = depths + self.surveys[index].df['elevation'].values[:,None]
@@ -2633,10 +3036,10 @@ class Problem(object):
         print('Trimming surveys and only keep common positions')
         self.trimSurveys()
         print('Computing relative ECa compared to background (1st survey).')
-        background = self.surveys[ref].df[self.coils].values
+        background = self.surveys[ref].getApps(self.coils)
         for i, s in enumerate(self.surveys):
             if i != ref: # the background survey stays the same
-                s.df.loc[:,self.coils] = s.df[self.coils].values - background
+                s.df.loc[:,self.coils] = s.getApps(self.coils) - background
         
         
     
@@ -2659,7 +3062,7 @@ class Problem(object):
         """Returns RMSPE for all coils (columns) and all surveys (row) as
         percentage.
         
-        np.sqrt(np.sum(((sim-obs)/obs)**2)/len(obs))*100
+        np.sqrt(np.nanmean(((sim-obs)/obs)**2))*100
         
         Parameters
         ----------
@@ -2674,19 +3077,15 @@ class Problem(object):
         if forwardModel is None:
             forwardModel = self.forwardModel
         dfsForward = self.forward(forwardModel=forwardModel)
-        def rmse(sim, obs):
-            return np.sqrt(np.sum(((sim - obs)/obs)**2)/len(obs))*100
         
         dfrmse = pd.DataFrame(columns=np.r_[self.coils, ['all']])
         for i in range(len(self.surveys)):
-            survey = self.surveys[i]
-            for coil in self.coils:
-                obsECa = survey.df[coil].values
-                simECa = dfsForward[i][coil].values
-                dfrmse.loc[i, coil] = rmse(simECa, obsECa)
-            obsECa = survey.df[self.coils].values.flatten()
-            simECa = dfsForward[i][self.coils].values.flatten()
-            dfrmse.loc[i, 'all'] = rmse(simECa, obsECa)
+            obsECa = self.surveys[i].getApps(self.coils)
+            simECa = dfsForward[i][self.coils].values
+            rerr2 = ((simECa - obsECa)/obsECa)**2 # (nrows, ncoils)
+            rmses = np.sqrt(np.nanmean(rerr2, axis=0))*100
+            rmseAll = np.sqrt(np.nanmean(rerr2))*100
+            dfrmse.loc[i, :] = np.r_[rmses, rmseAll]
         
         return dfrmse
         
@@ -2716,7 +3115,7 @@ class Problem(object):
         dfsForward = self.forward(forwardModel=forwardModel)
         survey = self.surveys[index]
         cols = survey.coils
-        obsECa = survey.df[cols].values
+        obsECa = survey.getApps(cols)
         simECa = dfsForward[index][cols].values
         if ax is None:
             fig, ax = plt.subplots()
@@ -2760,7 +3159,7 @@ class Problem(object):
         dfsForward = self.forward(forwardModel=forwardModel)
         survey = self.surveys[index]
         cols = survey.coils
-        obsECa = survey.df[cols].values
+        obsECa = survey.getApps(cols)
         simECa = dfsForward[index][cols].values
         #print('number of nan', np.sum(np.isnan(obsECa)), np.sum(np.isnan(simECa)))
         # rmses = np.sqrt(np.sum((obsECa - simECa)**2, axis=0)/np.sum(obsECa**2, axis=0)/obsECa.shape[0])*100 # old implementation
@@ -2768,10 +3167,11 @@ class Problem(object):
         # rmses = np.sqrt(np.sum((obsECa - simECa)**2, axis=0)/obsECa.shape[0])/np.sum(obsECa, axis=0)*100
         rmses = np.sqrt(np.sum(((obsECa - simECa)/obsECa)**2, axis=0)/obsECa.shape[0])*100 # root mean square percentage error
         rmse = np.sum(rmses)/len(self.coils)
+        omin, omax = percentile(obsECa, [5, 95])
         if vmin is None:
-            vmin = np.nanpercentile(obsECa.flatten(), 5)
+            vmin = omin
         if vmax is None:
-            vmax = np.nanpercentile(obsECa.flatten(), 95)
+            vmax = omax
         if ax is None:
             fig, ax = plt.subplots()
         ax.set_title('RMSPE: {:.3f} %'.format(rmse))
@@ -2829,7 +3229,7 @@ class Problem(object):
             If specified, the graph will be plotted agains this axis.
         """
         # TODO what about doing that for beta and gamma as well ?
-        app = self.surveys[isurvey].df[self.coils].values[irow,:]
+        app = self.surveys[isurvey].getApps(self.coils)[irow,:]
         if len(self.conds0) == 0: # not set
             depths0 = np.array(self.depths0)
             conds0 = np.ones(len(depths0) + 1)*20
@@ -2838,22 +3238,19 @@ class Problem(object):
             conds0 = self.conds0[isurvey][irow,:].copy()
         if alphas is None:
             alphas = np.logspace(-3,2,20)
-        def fmodel(p):
-            return fCS(p, depths0, self.cspacing, self.cpos)
-        L = buildSecondDiff(len(conds0))
-        def dataMisfit(p, app):
-            return fmodel(p) - app
-        def modelMisfit(p):
-            return np.dot(L, p)
-        def objfunc(p, app, alpha):
-            return np.sqrt(np.sum(dataMisfit(p, app)**2)/len(app)
-                           + alpha*np.sum(modelMisfit(p)**2)/len(p))
-        phiData = np.zeros(len(alphas))
-        phiModel = np.zeros(len(alphas))
-        for i, alpha in enumerate(alphas):
-            res = minimize(objfunc, conds0, args=(app, alpha))
-            phiData[i] = np.sum(dataMisfit(res.x, app)**2)
-            phiModel[i] = np.sum(modelMisfit(res.x)**2)
+        K = buildJacobian(depths0, self.cspacing, self.cpos) # fCS(p) == K @ p
+        LTL = self._getL(len(conds0))[1]
+        
+        # the objective ||K p - app||^2/Ncoils + alpha*||L p||^2/Nlayers is
+        # quadratic so its minimum is the solution of the normal equations,
+        # solved for all alphas at once (stack of Nalphas x Nlayers x Nlayers)
+        alphas = np.asarray(alphas, dtype=float)
+        KTK = np.dot(K.T, K)/len(app)
+        KTd = np.dot(K.T, app)/len(app)
+        A = KTK[None,:,:] + alphas[:,None,None]*LTL[None,:,:]/len(conds0)
+        ps = np.linalg.solve(A, np.repeat(KTd[None,:,None], len(alphas), axis=0))[:,:,0]
+        phiData = np.sum((np.dot(ps, K.T) - app)**2, axis=1)
+        phiModel = np.sum(np.dot(ps, LTL)*ps, axis=1) # ||Lp||^2
                     
         if ax is None:
             fig, ax = plt.subplots()
@@ -3090,9 +3487,8 @@ class Problem(object):
         if ax is None:
             fig, ax = plt.subplots()
         ax.plot(obsECa, simECa, '.')
-        x = np.r_[obsECa.flatten(), simECa.flatten()]
-        x = x[~np.isnan(x)]
-        vmin, vmax = np.nanmin(x), np.nanmax(x)
+        vmin = min(np.nanmin(obsECa), np.nanmin(simECa))
+        vmax = max(np.nanmax(obsECa), np.nanmax(simECa))
         ax.plot([vmin, vmax], [vmin, vmax], 'k-', label='1:1')
         ax.set_xlim([vmin, vmax])
         ax.set_ylim([vmin, vmax])
@@ -305,6 +305,26 @@ class Survey(object):
                 self.freqs = np.ones(len(self.coils))*freq
             if hx is not None:
                 self.hx = np.ones(len(self.coils))*hx
+    
+    
+    def getApps(self, coils=None, dtype=np.float64):
+        """Returns the apparent conductivities as an array of Nsample x Ncoils.
+        The array is extracted from `df` at each call (no extra copy if the
+        columns already have the requested dtype) so it reflects any change
+        made to `df`. It should be called once and reused rather than called
+        for each row and must not be modified in place.
+        
+        Parameters
+        ----------
+        coils : list of str, optional
+            Columns to extract. By default, all the coils of the survey.
+        dtype : numpy.dtype, optional
+            Floating point type of the array. The dataframe itself is not
+            modified.
+        """
+        if coils is None:
+            coils = self.coils
+        return self.df[coils].to_numpy(dtype=dtype)
         
     
     def readFile(self, fname, sensor=None, targetProjection=None, unit='ppt'):
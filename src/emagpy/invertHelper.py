@@ -11,7 +11,6 @@ getQ(), getQs(), getQ2() will return the complex ratio of Hs/Hp and not just
 its imaginary part (= the quadrature). Doing np.imag(getQ()) will return just
 the quadrature (imaginary part).
 """
-#from numba import njit, jit
 import os
 import numpy as np
 #import matplotlib.pyplot as plt
@@ -20,6 +19,18 @@ from scipy.constants import mu_0
 #from hankel import HankelTransform
 from scipy import special, integrate
 from scipy.optimize import newton, brent, minimize_scalar, minimize, curve_fit
+from scipy.linalg import cho_factor, cho_solve, lu_factor, lu_solve, LinAlgError
+
+# numba is optional, it is only used to speed up the CS inversion
+try:
+    from numba import njit, prange
+    GOT_NUMBA = True
+except ImportError:
+    GOT_NUMBA = False
+
+# compiled functions can only be cached on disk if the source file is shipped
+# (not the case for bytecode only or frozen distributions)
+NUMBA_CACHE = os.path.splitext(__file__)[1] == '.py'
 
 
 # useful functions for Hankel transform
@@ -432,6 +443,112 @@ def fMaxwellQ(cond, depths, s, cpos, hx=0, f=30000, maxiter=50):
     return response
 
 
+
+# --------------------- batched versions (several profiles at once)
+def getRn2batch(lamb, sigg, f, d):
+    """ Vectorized version of `getRn2()` for several profiles at once.
+    `sigg` is Nprofile x Nlayer and `d` is Nprofile x (Nlayer - 1) (layer
+    thicknesses). Returns the reflexion coefficients as Nprofile x Nlamb.
+    """
+    nprof = sigg.shape[0]
+    sigma = np.c_[np.zeros(nprof), sigg] # sigma 0 is above the ground
+    h = np.c_[np.zeros(nprof), d, np.zeros(nprof)] # first and last are not used (see getRn2())
+    def gamma(i):
+        return np.sqrt(lamb[None,:]**2 + 1j*2*np.pi*f*mu_0*sigma[:,[i]])
+    R = np.zeros((nprof, len(lamb)), dtype=complex) # no waves from the lower half space
+    gammaNext = gamma(sigma.shape[1]-1)
+    for i in range(sigma.shape[1]-2, -1, -1): # it's recursive so needs for loop
+        gammai = gamma(i)
+        r = (gammai - gammaNext)/(gammai + gammaNext)
+        e = R*np.exp(-2*gammaNext*h[:,[i+1]])
+        R = (r + e)/(1 + r*e)
+        gammaNext = gammai
+    return R
+
+
+def getQ2batch(cpos, s, sig, f, h):
+    """ Vectorized version of `getQ2()`. `sig` is Nprofile x Nlayer and `h`
+    is Nprofile x (Nlayer - 1). Returns an array of Nprofile complex Q.
+    """
+    lamb = hankel5_lamb/s # normalized to be used in Hankel
+    if cpos == 'vcp':
+        K = getRn2batch(lamb, sig, f, h)*lamb # kernel with reflexion coef
+        return 1-s**2*np.sum(hankel5_w1*K/s, axis=1)
+    elif cpos == 'hcp':
+        K = getRn2batch(lamb, sig, f, h)*lamb**2
+        return 1-s**3*np.sum(hankel5_w0*K/s, axis=1)
+    elif cpos == 'prp':
+        K = getRn2batch(lamb, sig, f, h)*lamb**2
+        return 0-s**3*np.sum(hankel5_w1*K/s, axis=1)
+
+
+def _getThickBatch(conds, depths, hx):
+    """ Returns the conductivities (S/m) and thicknesses of all profiles
+    with an air layer of 0 mS/m on top if `hx != 0`.
+    """
+    h = np.c_[depths[:,0], np.diff(depths, axis=1)] # layers thickness
+    sig = conds*1e-3 # convert to S/m
+    if hx != 0: # adding air layer of 0 mS/m
+        h = np.c_[np.ones(h.shape[0])*hx, h]
+        sig = np.c_[np.zeros(sig.shape[0]), sig]
+    return sig, h
+
+
+def fMaxwellECabatch(conds, depths, s, cpos, hx=0, f=30000):
+    """ Vectorized version of `fMaxwellECa()`. `conds` is Nprofile x Nlayer
+    and `depths` is Nprofile x (Nlayer - 1). Returns Nprofile x Ncoils.
+    """
+    conds = np.atleast_2d(conds)
+    depths = np.atleast_2d(depths)
+    if conds.shape[1]-1 != depths.shape[1]:
+        raise ValueError('conds.shape[1]-1 should be equal to depths.shape[1].')
+    if len(s) != len(cpos):
+        raise ValueError('len(s) should be equal to len(cpos).')
+    if isinstance(hx, int) or isinstance(hx, float):
+        hx = [hx] * len(s)
+    if isinstance(f, int) or isinstance(f, float):
+        f = [f] * len(s)
+    response = np.zeros((conds.shape[0], len(s)))*np.nan
+    for i in range(len(s)):
+        sig, thick = _getThickBatch(conds, depths, hx[i])
+        Q = getQ2batch(cpos[i], s[i], sig, f[i], thick)
+        response[:,i] = Q2eca(Q, s[i], f[i])*1e3
+    return response
+
+
+def fMaxwellQbatch(conds, depths, s, cpos, hx=0, f=30000, maxiter=50):
+    """ Vectorized version of `fMaxwellQ()`. `conds` is Nprofile x Nlayer
+    and `depths` is Nprofile x (Nlayer - 1). Returns Nprofile x Ncoils.
+    The root finding is done for all profiles at once.
+    """
+    conds = np.atleast_2d(conds)
+    depths = np.atleast_2d(depths)
+    if conds.shape[1]-1 != depths.shape[1]:
+        raise ValueError('conds.shape[1]-1 should be equal to depths.shape[1].')
+    if len(s) != len(cpos):
+        raise ValueError('len(s) should be equal to len(cpos).')
+    if isinstance(hx, int) or isinstance(hx, float):
+        hx = [hx] * len(s)
+    if isinstance(f, int) or isinstance(f, float):
+        f = [f] * len(s)
+    response = np.zeros((conds.shape[0], len(s)))*np.nan
+    for i in range(len(s)):
+        sig, thick = _getThickBatch(conds, depths, hx[i])
+        Qobs = np.imag(getQ2batch(cpos[i], s[i], sig, f[i], thick))
+        if cpos[i] == 'prp': # we don't have analytical for PRP
+            def objfunc(asig):
+                sigg = np.ones(sig.shape)*asig[:,None]
+                Qmod = np.imag(getQ2batch(cpos[i], s[i], sigg, f[i], thick))
+                return np.abs(Qmod - Qobs)
+        else:
+            def objfunc(asig): # analytical is much faster
+                Qmod = np.imag(getQhomogeneous(cpos[i], s[i], asig, f[i]))
+                return np.abs(Qmod - Qobs)
+        sig0 = Q2eca(getQ2batch(cpos[i], s[i], conds*1e-3, f[i], thick), s[i], f[i]) # still in S/m
+        response[:,i] = newton(objfunc, sig0, maxiter=maxiter)*1e3 # back to mS/m
+    return response
+
+
 # test
 #cpos = 'hcp'
 #s = 0.32
@@ -562,6 +679,65 @@ def fCS(cond, depths, s, cpos, hx=0, rescaled=False):
     return response
 
 
+def fCSbatch(conds, depths, s, cpos, hx=0, rescaled=False):
+    """ Vectorized version of `fCS()` for several profiles at once.
+
+    Parameters
+    ----------
+    conds : numpy.array
+        Array of shape Nprofile x Nlayer with the conductivities.
+    depths : numpy.array
+        Array of shape Nprofile x (Nlayer - 1) with the depths of the bottom
+        of each layer (positive number, without the leading 0). A vector of
+        length Nlayer - 1 can also be given if all profiles share the same depths.
+    s : array
+        Array of coil separation [m].
+    cpos : array of str
+        Array of coil orientation.
+    hx : float or array, optional
+        Height of the instrument above the ground for each coil.
+    rescaled : bool, optional
+        If `True`, the cumulative sensitivity is rescaled to reach 1 at the
+        ground surface when `hx != 0`.
+
+    Returns
+    -------
+    Array of shape Nprofile x Ncoils with the apparent conductivities.
+    """
+    conds = np.atleast_2d(conds)
+    depths = np.atleast_2d(depths)
+    if conds.shape[1]-1 != depths.shape[1]:
+        raise ValueError('conds.shape[1]-1 should be equal to depths.shape[1].')
+    if len(s) != len(cpos):
+        raise ValueError('len(s) should be equal to len(cpos).')
+    if isinstance(hx, int) or isinstance(hx, float):
+        hx = np.ones(len(cpos))*hx
+    if GOT_NUMBA and rescaled is False:
+        dtype = np.result_type(conds.dtype, depths.dtype, np.float32)
+        conds = np.ascontiguousarray(conds, dtype=dtype)
+        depths = np.ascontiguousarray(np.broadcast_to(
+            depths, (conds.shape[0], depths.shape[1])), dtype=dtype)
+        out = np.zeros((conds.shape[0], len(s)), dtype=dtype)
+        try:
+            fCSbatchnumba(conds, depths, np.asarray(s, dtype=dtype),
+                          np.array([dicoCpos[a] for a in cpos]),
+                          np.asarray(hx, dtype=dtype), out)
+            return out
+        except Exception: # numba failed (e.g. compilation), use NumPy below
+            pass
+    depths = np.c_[np.zeros(depths.shape[0]), depths]
+    out = np.zeros((conds.shape[0], len(s)))*np.nan
+    for i in range(len(s)):
+        cs = emSens(depths, s[i], cpos[i], hx[i]) # Nprofile x Nlayer
+        if (hx[i] != 0) and rescaled is True:
+            cs = cs/cs[:,[0]]
+        out[:,i] = np.sum(conds[:,:-1]*(cs[:,:-1]-cs[:,1:]), axis=1) \
+                   + conds[:,-1]*cs[:,-1]
+    ineg = np.broadcast_to((depths < 0).any(axis=1), out.shape[:1])
+    out[ineg,:] = np.nan # same as forward1d_full()
+    return out
+
+
 # based on Andrade2018 (general case)
 def emSensAndrade(depths,s,coilPosition, hx=0):
     """return RESCALED mcNeil senstivity values (Andrade 2018)
@@ -604,6 +780,130 @@ def fCSandrade(cond,depths,s,cpos, hx=None):
     return out
 
 
+# integer code of the coil orientation for the compiled functions
+dicoCpos = {'hcp': 0, 'vcp': 1, 'prp': 2}
+
+# same as fastmath=True but without assuming there is no NaN/inf so that
+# profiles with missing ECa still give a NaN response/objective
+fastmathFlags = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+if GOT_NUMBA:
+    @njit(fastmath=fastmathFlags, cache=NUMBA_CACHE)
+    def fCSnumba(cond, depths, s, cposi, hx):
+        """ Compiled version of `fCS()` (rescaled=False). `cposi` is the
+        coil orientation as integer (see `dicoCpos`) and `hx` an array.
+        """
+        out = np.zeros(s.shape[0])
+        for i in range(s.shape[0]):
+            csPrev = 0.0
+            for l in range(cond.shape[0]):
+                depth = 0.0 if l == 0 else depths[l-1]
+                z = (depth + np.abs(hx[i]))/s[i]
+                if cposi[i] == 0:
+                    cs = 1/np.sqrt(4*z**2 + 1)
+                elif cposi[i] == 1:
+                    cs = np.sqrt(4*z**2 + 1) - 2*z
+                else:
+                    cs = 1 - 2*z/np.sqrt(4*z**2 + 1)
+                if l > 0:
+                    out[i] += cond[l-1]*(csPrev - cs)
+                csPrev = cs
+            out[i] += cond[-1]*csPrev
+        return out
+
+    @njit(fastmath=fastmathFlags, cache=NUMBA_CACHE)
+    def objfuncCSnumba(p, app, pn, spn, depths, s, cposi, hx, alpha, beta, gamma):
+        """ Compiled L2 objective function of `Problem.invert()` for the CS
+        forward model when all conductivities are parameters. Used by the
+        methods that do not need the gradient (Nelder-Mead and MCMC), see
+        `objfuncGradCSnumba()` for the others.
+        """
+        sim = fCSnumba(p, depths, s, cposi, hx)
+        n = p.shape[0]
+        return np.sqrt(np.sum((sim - app)**2)/app.shape[0]
+                       + alpha*np.sum((p[:-1] - p[1:])**2)/n
+                       + beta*np.sum((p - pn)**2)/n
+                       + gamma*np.sum((p - spn)**2)/n)
+
+    @njit(fastmath=fastmathFlags, cache=NUMBA_CACHE)
+    def objfuncGradCSnumba(p, app, pn, spn, depths, s, cposi, hx, alpha, beta, gamma):
+        """ Same as `objfuncCSnumba()` but also returns the gradient of the
+        objective function (for L-BFGS-B, TNC and CG). NaN observations give
+        a NaN objective as with the Python version.
+        """
+        n = p.shape[0]
+        m = s.shape[0]
+        # kernel of the CS forward model (the response is K @ p)
+        K = np.zeros((m, n))
+        for i in range(m):
+            csPrev = 0.0
+            for l in range(n):
+                depth = 0.0 if l == 0 else depths[l-1]
+                z = (depth + np.abs(hx[i]))/s[i]
+                if cposi[i] == 0:
+                    cs = 1/np.sqrt(4*z**2 + 1)
+                elif cposi[i] == 1:
+                    cs = np.sqrt(4*z**2 + 1) - 2*z
+                else:
+                    cs = 1 - 2*z/np.sqrt(4*z**2 + 1)
+                if l > 0:
+                    K[i,l-1] = csPrev - cs
+                csPrev = cs
+            K[i,n-1] = csPrev
+        misfit = np.zeros(m)
+        for i in range(m):
+            for l in range(n):
+                misfit[i] += K[i,l]*p[l]
+            misfit[i] -= app[i]
+        dm = p[:-1] - p[1:]
+        val = np.sqrt(np.sum(misfit**2)/m
+                      + alpha*np.sum(dm**2)/n
+                      + beta*np.sum((p - pn)**2)/n
+                      + gamma*np.sum((p - spn)**2)/n)
+        grad = 2*beta*(p - pn)/n + 2*gamma*(p - spn)/n
+        for l in range(n):
+            for i in range(m):
+                grad[l] += 2*K[i,l]*misfit[i]/m
+        grad[:-1] += 2*alpha*dm/n
+        grad[1:] -= 2*alpha*dm/n
+        if val > 0: # d(sqrt(x)) = dx/(2*sqrt(x))
+            grad = grad/(2*val)
+        return val, grad
+
+    @njit(parallel=True, fastmath=fastmathFlags, cache=NUMBA_CACHE)
+    def fCSbatchnumba(conds, depths, s, cposi, hx, out):
+        """ Compiled version of `fCSbatch()` (rescaled=False), the profiles
+        are computed in parallel. `conds` is Nprofile x Nlayer, `depths` is
+        Nprofile x (Nlayer - 1) and the result is written in `out`
+        (Nprofile x Ncoils).
+        """
+        nlayer = conds.shape[1]
+        for j in prange(conds.shape[0]):
+            neg = False
+            for l in range(nlayer - 1):
+                if depths[j,l] < 0:
+                    neg = True
+            for i in range(s.shape[0]):
+                if neg: # same as forward1d_full()
+                    out[j,i] = np.nan
+                    continue
+                app = 0.0
+                csPrev = 0.0
+                for l in range(nlayer):
+                    depth = 0.0 if l == 0 else depths[j,l-1]
+                    z = (depth + np.abs(hx[i]))/s[i]
+                    if cposi[i] == 0:
+                        cs = 1/np.sqrt(4*z**2 + 1)
+                    elif cposi[i] == 1:
+                        cs = np.sqrt(4*z**2 + 1) - 2*z
+                    else:
+                        cs = 1 - 2*z/np.sqrt(4*z**2 + 1)
+                    if l > 0:
+                        app += conds[j,l-1]*(csPrev - cs)
+                    csPrev = cs
+                out[j,i] = app + conds[j,nlayer-1]*csPrev
+
+
 def buildSecondDiff(ndiag):
     x=np.ones(ndiag)
     a=np.diag(x[:-1]*-1,k=-1)+np.diag(x*2,k=0)+np.diag(x[:-1]*-1,k=1)
@@ -612,6 +912,27 @@ def buildSecondDiff(ndiag):
     return a
 
 
+def factorize(A):
+    """ Factorize the square matrix A once and return a function solving
+    A x = b for one or several right hand sides (columns of b). Cholesky is
+    used if A is symmetric positive definite, LU otherwise. The columns of b
+    are solved independently so a column containing NaN (e.g. a profile
+    with a missing ECa) only gives NaN in the same column of x.
+    """
+    if np.allclose(A, A.T):
+        try:
+            c = cho_factor(A)
+            def solve(b):
+                return cho_solve(c, b, check_finite=False)
+            return solve
+        except LinAlgError: # not positive definite
+            pass
+    lu = lu_factor(A)
+    def solve(b):
+        return lu_solve(lu, b, check_finite=False)
+    return solve
+
+
 #%% test bench
 # sigma = np.array([30, 30, 30, 30]) # layers conductivity [mS/m]
 # depths = np.array([0.3, 0.7, 2]) # thickness of each layer (last is infinite)
@@ -633,19 +954,24 @@ def buildSecondDiff(ndiag):
 
 
 #%% usefull functions for the direct inversion
-def buildJacobian(depths, s, cpos):
+def buildJacobian(depths, s, cpos, hx=0, rescaled=False):
     '''Build Jacobian matrix for Cumulative Sensitivity based inversion.
+    As the CS forward model is linear, `fCS(cond, depths, s, cpos, hx)` is
+    equal to `np.dot(buildJacobian(depths, s, cpos, hx), cond)`.
     
     Parameters
     ----------
-    cond : array
-        Conductivities of the model layer.
     depths : array
         Depths of the lower layer bound.
     s : array
         Array of coil separation [m].
     cpos : array of str
         Array of coil orientation.
+    hx : float or array, optional
+        Height of the instrument above the ground for each coil.
+    rescaled : bool, optional
+        If `True`, the cumulative sensitivity is rescaled to reach 1 at the
+        ground surface when `hx != 0`.
     
     Returns
     -------
@@ -653,9 +979,11 @@ def buildJacobian(depths, s, cpos):
     model parameters (per layer).
     '''
     depths = np.r_[0, depths]
+    if isinstance(hx, int) or isinstance(hx, float):
+        hx = np.ones(len(s))*hx
     jacob = np.zeros((len(s),len(depths)))*np.nan
     for i in range(0,len(s)):      
-        cs = emSens(depths, s[i], cpos[i])         
+        cs = emSens(depths, s[i], cpos[i], hx[i], rescaled=rescaled)
         jacob[i,:-1] = cs[:-1]-cs[1:]
         jacob[i,-1] = cs[-1]
     return jacob
@@ -178,6 +178,46 @@ k.showResults(ax=ax, rmse=True, vmin=10, vmax=30)
 ax.set_title('(c) FSeq with Gauss-Newton')
 
 
+#%% Gauss-Newton with a missing ECa (only this profile should be NaN)
+k = Problem()
+k.createSurvey(datadir + 'cover-crop/coverCropTransect.csv')
+k.surveys[0].df.loc[k.surveys[0].df.index[3], k.coils[1]] = np.nan
+k.invertGN()
+print('NaN profiles:', np.where(np.isnan(k.models[0]).any(axis=1))[0])
+k.showResults(rmse=True)
+for fm in ['CS', 'FSlin', 'FSeq']:
+    k.invert(forwardModel=fm, method='Gauss-Newton')
+    print(fm, 'NaN profiles:', np.where(np.isnan(k.models[0]).any(axis=1))[0])
+
+
+#%% solver options compared to the default L-BFGS-B (with a missing ECa)
+k = Problem()
+k.createSurvey(datadir + 'cover-crop/coverCropTransect.csv')
+k.surveys[0].df.loc[k.surveys[0].df.index[3], k.coils[1]] = np.nan
+k.invert()
+model0 = k.models[0]
+k.invert(method='lsq')
+print('lsq: max difference {:.3f} mS/m'.format(np.nanmax(np.abs(k.models[0] - model0))))
+k.invert(method='lsq', options={'maxiter': 3}, bnds=[(1, None)]*3)
+print('lsq (maxiter=3): {:.2f}%'.format(np.nanmean(k.misfits[0])))
+k.invert(vectorized=True)
+print('vectorized: max difference {:.3f} mS/m'.format(np.nanmax(np.abs(k.models[0] - model0))))
+k.invert(vectorized=True, forwardModel='FSlin') # falls back to row by row
+k.showResults(rmse=True)
+
+k32 = Problem(dtype=np.float32)
+k32.createSurvey(datadir + 'cover-crop/coverCropTransect.csv')
+k32.surveys[0].df.loc[k32.surveys[0].df.index[3], k32.coils[1]] = np.nan
+k32.invert()
+print('float32 ({}): max difference {:.3f} mS/m'.format(
+    k32.models[0].dtype, np.nanmax(np.abs(k32.models[0] - model0))))
+
+# data modified in place are used by the next inversion
+k.surveys[0].df.loc[:, k.coils] = k.surveys[0].df[k.coils].values*2
+k.invert()
+print('doubled ECa: EC ratio {:.2f}'.format(np.nanmean(k.models[0])/np.nanmean(model0)))
+
+
 #%% test lateral smoothing
 k = Problem()
 k.createSurvey(datadir + 'cover-crop/coverCrop.csv')
@@ -250,6 +290,17 @@ print('PAR elapsed {:.2f}s'.format(time.time() - t0))
 k.showResults()
 
 
+#%% parallel inversion with lateral smoothing (contiguous chunks of profiles)
+k = Problem()
+k.createSurvey(datadir + 'cover-crop/coverCrop.csv')
+k.invert(beta=0.1, njobs=1)
+model1 = k.models[0]
+rmspe1 = np.nanmean(k.misfits[0])
+k.invert(beta=0.1, njobs=2)
+print('beta=0.1 RMSPE: SEQ {:.2f}%, PAR {:.2f}%, max model difference {:.2f} mS/m'.format(
+    rmspe1, np.nanmean(k.misfits[0]), np.nanmax(np.abs(k.models[0] - model1))))
+
+
 #%% calibration with Boxford dataset
 k = Problem()
 k.createSurvey(datadir + 'boxford-calib/eca_calibration.csv')